@@ -19,7 +19,10 @@ Framework functions:
   cancel(fn) - Cancel any timer or hook for function fn.
 
   enable_speaker(on=True) - Enable or disable the onboard speaker.
-  sample(frequency) - Generate a sine wave sample for the given frequency.
+  sample(frequency, wave="square") - Generate a "square", "saw", or "sine" wave sample
+    for the given frequency.
+  precompute_samples(frequencies, wave="square") - Generate and cache samples for the
+    given frequencies ahead of time.
   play_sound(sample, duration) - Play a given sample for the given duration.
   stop_sound() - Stop all currently-playing sounds.
 
@@ -32,8 +35,7 @@ __author__ = "John Reese"
 __version__ = "0.5"
 
 import array
-import math
-import re
+import heapq
 import time
 
 import board
@@ -42,44 +44,98 @@ from audioio import AudioOut, RawSample
 from digitalio import DigitalInOut, Direction, Pull
 from touchio import TouchIn
 
+try:
+    from micropython import const
+except ImportError:
+
+    def const(value):
+        # type: (int) -> int
+        return value
+
+
 try:
     from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 except ImportError:
     pass
 
-ANALOG_RE = re.compile(r"(A\d+)")
-DIGITAL_RE = re.compile(r"(D\d+|BUTTON_)")
-
 # External constants
 
-DOWN = 1
-UP = 2
+DOWN = const(1)
+UP = const(2)
 PROPOGATE = object()
 
 # Internal constants
 
-PINS = sorted(dir(board))
-DIGITALIO = [getattr(board, pin) for pin in PINS if DIGITAL_RE.match(pin)]
-TOUCHIO = [getattr(board, pin) for pin in PINS if ANALOG_RE.match(pin)]
-SAMPLERATE = 8000  # recommended
-
-AUDIO = AudioOut(board.A0)
-SPEAKER = DigitalInOut(board.SPEAKER_ENABLE)
-SPEAKER.direction = Direction.OUTPUT
+DIGITALIO = []  # type: List[Any]  # filled by load_pins()
+TOUCHIO = []  # type: List[Any]  # filled by load_pins()
+# Each wave is a single period, looped by AudioOut at len(wave) * frequency.
+# Tables are kept short so that rate stays within what the DAC can play.
+WAVE_SIZE = const(32)
+# SINE is precomputed to skip math.sin at import; regenerate with
+# b"".join(struct.pack("<H", int(math.sin(math.pi * 2 * i / 32) * 32767 + 32768))
+#     for i in range(32))
+SINE = array.array(
+    "H",
+    (
+        b"\x00\x80\xf8\x98\xfb\xb0\x1c\xc7\x81\xda\x6c\xea\x40\xf6\x89\xfd"
+        b"\xff\xff\x89\xfd\x40\xf6\x6c\xea\x81\xda\x1c\xc7\xfb\xb0\xf8\x98"
+        b"\x00\x80\x07\x67\x04\x4f\xe3\x38\x7e\x25\x93\x15\xbf\x09\x76\x02"
+        b"\x01\x00\x76\x02\xbf\x09\x93\x15\x7e\x25\xe3\x38\x04\x4f\x07\x67"
+    ),
+)
+SQUARE = array.array("H", [0, 65535])
+SAW = array.array("H", [i * 65535 // (WAVE_SIZE - 1) for i in range(WAVE_SIZE)])
+WAVES = {"sine": SINE, "square": SQUARE, "saw": SAW}
+SAMPLE_CACHE = const(32)
+EPOCH = time.monotonic()  # scheduler times are small-int ms since import
+DEBOUNCE = const(40)  # ms, about two Gamepad polls
+MIN_SLEEP = const(1)  # ms, resolution of the monotonic clock on most ports
 
 # Internal state
 
 RUNNING = True
-INTERVALS = {}  # type: Dict[Callable, Tuple[float, float]]
-TIMERS = {}  # type: Dict[Callable, float]
+AUDIO = None  # type: Optional[AudioOut]  # created by audio()
+SPEAKER = None  # type: Optional[DigitalInOut]  # created by speaker()
+HEAP = []  # type: List[List[Any]]  # [target_ms, sequence, fn, interval_ms]
+SEQUENCE = 0
+INTERVALS = {}  # type: Dict[Callable, List[Any]]
+TIMERS = {}  # type: Dict[Callable, List[Any]]
 BUTTONS = []  # type: List[Any]
+BITS = []  # type: List[int]
 DIOS = []  # type: List[DigitalInOut]
-PRESSES = []  # type: List[Tuple[Callable, Sequence[Any], int]]
+CHANGES = []  # type: List[int]  # last accepted state change per button, ms
+PRESSES = []  # type: List[Tuple[Callable, int, int]]
+POLLING = 0  # bits of buttons with at least one registered handler
+SAMPLES = {}  # type: Dict[Tuple[int, str], RawSample]
+SAMPLE_KEYS = []  # type: List[Tuple[int, str]]
+
+
+def push(entry, target):
+    # type: (List[Any], int) -> List[Any]
+    global SEQUENCE
+    SEQUENCE += 1
+    entry[0] = target
+    entry[1] = SEQUENCE
+    heapq.heappush(HEAP, entry)
+    return entry
+
+
+def unschedule(entries, fn):
+    # type: (Dict[Callable, List[Any]], Callable) -> None
+    entry = entries.pop(fn, None)
+    if entry:
+        entry[2] = None
+
+
+def millis(seconds):
+    # type: (float) -> int
+    return int((seconds - EPOCH) * 1000)
 
 
 def tick(fn):
     # type: (Callable) -> Callable
-    INTERVALS[fn] = (0, 0)
+    unschedule(INTERVALS, fn)
+    INTERVALS[fn] = push([0, 0, fn, 0], 0)
     return fn
 
 
@@ -87,7 +143,8 @@ def every(interval, fn=None):
     # type: (float, Optional[Callable]) -> Callable
 
     def wrapper(fn):
-        INTERVALS[fn] = (interval, 0)
+        unschedule(INTERVALS, fn)
+        INTERVALS[fn] = push([0, 0, fn, int(interval * 1000)], 0)
         return fn
 
     if fn:
@@ -96,32 +153,53 @@ def every(interval, fn=None):
     return wrapper
 
 
+def timer(fn, target):
+    # type: (Callable, int) -> None
+    unschedule(TIMERS, fn)
+    TIMERS[fn] = push([0, 0, fn, None], target)
+
+
 def at(target, fn):
     # type: (float, Callable) -> None
-    TIMERS[fn] = target
+    timer(fn, millis(target))
 
 
 def after(target, fn):
     # type: (float, Callable) -> None
-    TIMERS[fn] = time.monotonic() + target
+    timer(fn, millis(time.monotonic() + target))
 
 
 def cancel(*fns):
     # type: (Callable) -> None
+    global POLLING
+
     for fn in fns:
-        INTERVALS.pop(fn, None)
-        TIMERS.pop(fn, None)
+        unschedule(INTERVALS, fn)
+        unschedule(TIMERS, fn)
 
-        for idx, press in enumerate(PRESSES):
-            if press[0] == fn:
-                PRESSES.pop(idx)
-                break
+    PRESSES[:] = [press for press in PRESSES if press[0] not in fns]
+
+    POLLING = 0
+    for press in PRESSES:
+        POLLING |= press[1]
+
+
+def load_pins():
+    # type: () -> None
+    for pin in dir(board):
+        if pin.startswith("BUTTON_") or (pin[:1] == "D" and pin[1:2].isdigit()):
+            DIGITALIO.append(getattr(board, pin))
+        elif pin[:1] == "A" and pin[1:2].isdigit():
+            TOUCHIO.append(getattr(board, pin))
 
 
 def on(*buttons, fn=None, action=DOWN):
     # type: (Any, Callable, int) -> Callable
     global GAMEPAD
 
+    if not (DIGITALIO or TOUCHIO):
+        load_pins()
+
     for button in buttons:
         if button not in BUTTONS:
             if button in DIGITALIO:
@@ -133,12 +211,18 @@ def on(*buttons, fn=None, action=DOWN):
             else:
                 print("unknown button {}".format(button))
             BUTTONS.append(button)
+            BITS.append(1 << len(BITS))
             DIOS.append(dio)
+            CHANGES.append(-DEBOUNCE)
 
-    value = tuple(buttons)
+    mask = 0
+    for button in buttons:
+        mask |= BITS[BUTTONS.index(button)]
 
     def wrapper(fn):
-        PRESSES.append((fn, buttons, action))
+        global POLLING
+        PRESSES.append((fn, mask, action))
+        POLLING |= mask
         return fn
 
     if fn:
@@ -147,30 +231,69 @@ def on(*buttons, fn=None, action=DOWN):
     return wrapper
 
 
+def speaker():
+    # type: () -> DigitalInOut
+    global SPEAKER
+    if SPEAKER is None:
+        SPEAKER = DigitalInOut(board.SPEAKER_ENABLE)
+        SPEAKER.direction = Direction.OUTPUT
+    return SPEAKER
+
+
+def audio():
+    # type: () -> AudioOut
+    global AUDIO
+    if AUDIO is None:
+        speaker()  # keep the amplifier off until enable_speaker() is called
+        AUDIO = AudioOut(board.A0)
+    return AUDIO
+
+
 def enable_speaker(on=True):
     # type: (bool) -> None
     print("speaker {}".format("on" if on else "off"))
-    SPEAKER.value = on
+    speaker().value = on
+
+
+def build_sample(frequency, wave):
+    # type: (int, str) -> RawSample
+    if wave not in WAVES:
+        raise ValueError("unknown wave {}".format(wave))
+
+    table = WAVES[wave]
+    return RawSample(table, sample_rate=len(table) * frequency)
+
+
+def sample(frequency, wave="square"):
+    # type: (int, str) -> RawSample
+    key = (int(frequency), wave)
+    if key in SAMPLES:
+        return SAMPLES[key]
 
+    raw = build_sample(key[0], wave)
+    SAMPLES[key] = raw
+    SAMPLE_KEYS.append(key)
+    if len(SAMPLE_KEYS) > SAMPLE_CACHE:
+        del SAMPLES[SAMPLE_KEYS.pop(0)]
+    return raw
 
-def sample(frequency):
-    # type: (int) -> RawSample
-    length = SAMPLERATE // frequency
-    sine_wave = array.array("H", [0] * length)
-    for i in range(length):
-        sine_wave[i] = int(math.sin(math.pi * 2 * i / 18) * (2 ** 15) + 2 ** 15)
-    return RawSample(sine_wave)
+
+def precompute_samples(frequencies, wave="square"):
+    # type: (Sequence[int], str) -> None
+    for frequency in frequencies:
+        sample(frequency, wave)
 
 
 def play_sound(sample, duration):
     # type: (RawSample, float) -> None
-    AUDIO.play(sample, loop=True)
+    audio().play(sample, loop=True)
     after(duration, stop_sound)
 
 
 def stop_sound(*args):
     # type: (Any) -> None
-    AUDIO.stop()
+    if AUDIO is not None:
+        AUDIO.stop()
 
 
 def stop():
@@ -187,71 +310,92 @@ def start(fn=None):
     if fn:
         at(0, fn)
 
+    # bind hot lookups to locals once, rather than walking module dicts every pass
+    monotonic = time.monotonic
+    sleep = time.sleep
+    heappop = heapq.heappop
+    heap = HEAP
+    intervals = INTERVALS
+    timers = TIMERS
+
     while True:
-        if not TIMERS and not INTERVALS:
+        if not timers and not intervals:
             print("No functions registered, quitting")
             return
 
-        now = time.monotonic()
-        for fn, (interval, last_called) in INTERVALS.items():
-            target = last_called + interval
-            if target <= now:
-                fn(now)
-                INTERVALS[fn] = (interval, now)
-                target += interval
-
-        for fn, target in TIMERS.items():
-            if target <= now:
-                del TIMERS[fn]
-                fn(now)
-
-        next_target = min(
-            [last_called + interval for last_called, interval in INTERVALS.values()]
-            + [target for target in TIMERS.values()]
-        )
-
-        while True:
-            slp = next_target - time.monotonic()
-            if slp > 0:
-                # print("Sleeping for {} seconds".format(slp))
-                time.sleep(slp)
+        seconds = monotonic()
+        now = int((seconds - EPOCH) * 1000)
+        mark = SEQUENCE  # entries pushed while dispatching wait for the next pass
+        while heap and heap[0][0] <= now and heap[0][1] <= mark:
+            entry = heappop(heap)
+            fn, interval = entry[2], entry[3]
+            if fn is None:
+                continue
+
+            if interval is None:
+                del timers[fn]
+                fn(seconds)
             else:
-                break
+                fn(seconds)
+                if entry[2] is not None:
+                    push(entry, now + interval)
+
+        # drop cancelled entries so they can't set the next deadline
+        while heap and heap[0][2] is None:
+            heappop(heap)
+
+        if not heap:
+            continue
+
+        slp = heap[0][0] - int((monotonic() - EPOCH) * 1000)
+        if slp > MIN_SLEEP:
+            # print("Sleeping for {} ms".format(slp))
+            sleep(slp / 1000)
 
 
 class Gamepad:
     def __init__(self):
-        self.down = ()
-        self.pressed = []
+        self.down = 0
+        self.pressed = 0
 
     def __call__(self, now):
-        down = tuple(button for button, dio in zip(BUTTONS, DIOS) if dio.value)
+        polling = POLLING
+        down = 0
+        for bit, dio in zip(BITS, DIOS):
+            if bit & polling and dio.value:
+                down |= bit
+
+        # a new state only counts once it reads the same on two polls in a row
         if down != self.down:
             self.down = down
             return
 
-        fresh_down = [b for b in down if b not in self.pressed]
-        fresh_up = [b for b in self.pressed if b not in down]
-
-        if fresh_down:
-            # print("fresh down: {}".format(fresh_down))
-            self.pressed.extend(fresh_down)
+        changed = down ^ self.pressed
+        if not changed:
+            return
 
-        if fresh_up:
-            # print("fresh up: {}".format(fresh_up))
-            for btn in fresh_up:
-                self.pressed.remove(btn)
+        # ignore buttons that already changed state within the debounce window
+        now_ms = millis(now)
+        accepted = 0
+        for idx, bit in enumerate(BITS):
+            if changed & bit and now_ms - CHANGES[idx] >= DEBOUNCE:
+                CHANGES[idx] = now_ms
+                accepted |= bit
 
-        if not (fresh_down or fresh_up):
+        if not accepted:
             return
 
-        for (fn, buttons, action) in PRESSES:
-            if action == DOWN and all(b in fresh_down for b in buttons):
-                v = fn(now)
-            elif action == UP and all(b in fresh_up for b in buttons):
-                v = fn(now)
-            else:
-                v = PROPOGATE
+        fresh_down = accepted & down
+        fresh_up = accepted & ~down
+        # print("fresh down: {:b}, fresh up: {:b}".format(fresh_down, fresh_up))
+        self.pressed ^= accepted
+
+        for (fn, mask, action) in tuple(PRESSES):
+            if action == DOWN:
+                if fresh_down & mask != mask:
+                    continue
+            elif action != UP or fresh_up & mask != mask:
+                continue
 
-            if v is not PROPOGATE:
-                break
+            if fn(now) is not PROPOGATE:
+                return